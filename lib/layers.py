@@ -7,7 +7,7 @@ class Dense:
     def __init__(
         self, name,
         inp_size, out_size, activation=nop,
-        W=None, b=None,
+        W=None, b=None, dtype=None,
     ):
         """
         Dense layer that actually creates all it's variables on init.
@@ -18,6 +18,7 @@ class Dense:
             shape should be (inp_size, out_size)
         :param b: tf tensor (to be used permanently) or tf initializer (to be used at init)
             shape should be (out_size,)
+        :param dtype: if given, W and b are cast to this dtype, e.g. float16 computations with float32 variables
         Stores two variables: name/W and name/b
         """
         self.name = name
@@ -36,6 +37,9 @@ class Dense:
             else:
                 self.b = tf.get_variable('b', shape=[out_size], initializer=b)
 
+            if dtype is not None:
+                self.W, self.b = tf.cast(self.W, dtype), tf.cast(self.b, dtype)
+
     def __call__(self, inp):
         """
         inp: [..., inp_size]
@@ -320,10 +324,12 @@ class LayerNorm:
 
     def __call__(self, inp):
         with tf.variable_scope(self.name):
+            # reductions are always done in float32, output has the same dtype as input
+            inp_dtype, inp = inp.dtype, tf.to_float(inp)
             mean = tf.reduce_mean(inp, axis=[-1], keep_dims=True)
             variance = tf.reduce_mean(tf.square(inp - mean), axis=[-1], keep_dims=True)
             norm_x = (inp - mean) * tf.rsqrt(variance + self.epsilon)
-            return norm_x * self.scale + self.bias
+            return tf.cast(norm_x * self.scale + self.bias, inp_dtype)
 
 
 class Wrapper:
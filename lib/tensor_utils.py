@@ -125,15 +125,53 @@ def dropout_scope(enabled):
     inside model(x):
     if is_dropout_enabled():
         x = tf.nn.dropout(x, 0.5)
+
+    enabled must be a python bool: dropout branches are resolved while building the graph,
+    so inference graphs contain no dropout ops at all
     """
+    assert not is_tf_tensor(enabled), "dropout_scope expects a python bool, not a tensor"
     was_enabled = is_dropout_enabled()
-    _tls.dropout_enabled = enabled
+    _tls.dropout_enabled = bool(enabled)
     try:
         yield
     finally:
         _tls.dropout_enabled = was_enabled
 
 
+def is_jit_enabled():
+    """
+    Returns True if ops created in current context are marked for XLA compilation (see jit_scope)
+    """
+    if not hasattr(_tls, 'jit_enabled'):
+        _tls.jit_enabled = False
+    return _tls.jit_enabled
+
+
+@contextmanager
+def jit_scope(enabled=True):
+    """
+    Usage:
+    with jit_scope(True):
+        y = model(x)
+
+    All ops created inside are marked for XLA compilation, so that chains of elementwise ops
+    get fused into a few kernels. Nested scopes with the same value do nothing: this keeps
+    all ops in one xla scope, otherwise XLA would not cluster them together.
+    """
+    was_enabled = is_jit_enabled()
+    if enabled == was_enabled:
+        yield
+        return
+
+    from tensorflow.contrib.compiler import jit
+    _tls.jit_enabled = enabled
+    try:
+        with jit.experimental_jit_scope(compile_ops=enabled):
+            yield
+    finally:
+        _tls.jit_enabled = was_enabled
+
+
 def log_sigmoid(x): return -tf.nn.softplus(-x)
 
 
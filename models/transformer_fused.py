@@ -17,7 +17,7 @@ from .transformer_other import Transformer
 class Model(TranslateModel):
 
     DecState = namedtuple("transformer_state", ['enc_out', 'enc_attn_mask', 'attnP', 'rdo', 'out_seq', 'offset',
-                                                'emb', 'dec_layers', 'dec_enc_kv', 'dec_dec_kv'])
+                                                'dec_enc_kv', 'dec_dec_kv'])
 
     def __init__(self, name, inp_voc, out_voc, lm, gate_hid_size=None, **hp):
         self.name = name
@@ -74,7 +74,7 @@ class Model(TranslateModel):
         """
         inp = batch['inp']
         inp_len = batch.get('inp_len', infer_length(inp, self.inp_voc.eos, time_major=False))
-        with dropout_scope(is_train), tf.name_scope(self.transformer.name):
+        with dropout_scope(is_train), jit_scope(self.transformer.use_xla), tf.name_scope(self.transformer.name):
             if self.debug:
                 inp = tf.Print(inp, [tf.shape(inp), inp], message="encode(): inp", first_n=100, summarize=100)
 
@@ -86,30 +86,30 @@ class Model(TranslateModel):
             batch_size = tf.shape(inp)[0]
             hid_size = tf.shape(enc_out)[-1]
             out_seq = tf.zeros([batch_size, 0], dtype=inp.dtype)
-            rdo = tf.zeros([batch_size, hid_size], dtype=enc_out.dtype)
+            rdo = tf.zeros([batch_size, hid_size], dtype=tf.float32)
 
             attnP = tf.ones([batch_size, ninp]) / tf.to_float(inp_len)[:, None]
 
             offset = tf.zeros((batch_size,))
             if self.transformer.dst_rand_offset:
                 BIG_LEN = 32000
-                random_offset = tf.random_uniform(tf.shape(offset), minval=-BIG_LEN, maxval=BIG_LEN, dtype=tf.int32)
+                with jit_scope(False):  # integer random_uniform has no XLA kernel
+                    random_offset = tf.random_uniform(tf.shape(offset), minval=-BIG_LEN, maxval=BIG_LEN,
+                                                      dtype=tf.int32)
                 offset += tf.to_float(random_offset)
 
             trans = self.transformer
-            empty_emb = tf.zeros([batch_size, 0, trans.emb_size])
-            empty_dec_layers = [tf.zeros([batch_size, 0, trans.hid_size])] * trans.num_layers_dec
-            input_layers = [empty_emb] + empty_dec_layers[:-1]
-
-            #prepare kv parts for all decoder attention layers. Note: we do not preprocess enc_out
-            # for each layer because ResidualLayerWrapper only preprocesses first input (query)
-            dec_enc_kv = [layer.kv_conv(enc_out)
-                          for i, layer in enumerate(trans.dec_enc_attn)]
-            dec_dec_kv = [layer.kv_conv(layer.preprocess(input_layers[i]))
-                          for i, layer in enumerate(trans.dec_attn)]
+            # prepare kv parts for all decoder attention layers
+            dec_enc_kv = trans._make_dec_enc_kv(enc_out)
+            # self-attention cache is empty before the first step, no need to project anything
+            dec_dec_kv = [(tf.zeros([batch_size, layer.num_heads, 0, layer.key_depth // layer.num_heads],
+                                    dtype=trans.compute_dtype),
+                           tf.zeros([batch_size, layer.num_heads, 0, layer.value_depth // layer.num_heads],
+                                    dtype=trans.compute_dtype))
+                          for layer in trans.dec_attn]
 
             new_state = self.DecState(enc_out, enc_attn_mask, attnP, rdo, out_seq, offset,
-                                      empty_emb, empty_dec_layers, dec_enc_kv, dec_dec_kv)
+                                      dec_enc_kv, dec_dec_kv)
 
             # perform initial decode (instead of force_bos) with zero embeddings
             new_state = self.decode(new_state, is_train=is_train)
@@ -124,8 +124,7 @@ class Model(TranslateModel):
         :param is_train: if True, enables dropouts
         """
         trans = self.transformer
-        enc_out, enc_attn_mask, attnP, rdo, out_seq, offset, prev_emb = dec_state[:7]
-        prev_dec_layers = dec_state.dec_layers
+        enc_out, enc_attn_mask, attnP, rdo, out_seq, offset = dec_state[:6]
         dec_enc_kv = dec_state.dec_enc_kv
         dec_dec_kv = dec_state.dec_dec_kv
 
@@ -133,7 +132,7 @@ class Model(TranslateModel):
         if words is not None:
             out_seq = tf.concat([out_seq, tf.expand_dims(words, 1)], 1)
 
-        with dropout_scope(is_train), tf.name_scope(trans.name):
+        with dropout_scope(is_train), jit_scope(trans.use_xla), tf.name_scope(trans.name):
             # Embeddings
             if words is None:
                 # initial step: words are None
@@ -144,7 +143,8 @@ class Model(TranslateModel):
                     emb_out *= trans.emb_size ** .5
 
             # Prepare decoder
-            dec_inp_t = trans._add_timing_signal(emb_out, offset=offset)
+            dec_inp_t = tf.cast(trans._add_timing_signal(emb_out, offset=offset), trans.compute_dtype)
+            dec_inp_t.set_shape([None, 1, None])  # a single time-step, see _attention_transpose
             # Apply dropouts
             if is_dropout_enabled():
                 dec_inp_t = tf.nn.dropout(dec_inp_t, 1.0 - trans.res_dropout)
@@ -152,36 +152,36 @@ class Model(TranslateModel):
             # bypass info from Encoder to avoid None gradients for num_layers_dec == 0
             if trans.num_layers_dec == 0:
                 inp_mask = tf.squeeze(tf.transpose(enc_attn_mask, perm=[3, 1, 2, 0]), 3)
-                dec_inp_t += tf.reduce_mean(enc_out * inp_mask, axis=[0, 1], keep_dims=True)
+                dec_inp_t += tf.reduce_mean(enc_out * tf.cast(inp_mask, enc_out.dtype), axis=[0, 1], keep_dims=True)
 
             # Decoder
-            new_emb = tf.concat([prev_emb, dec_inp_t], axis=1)
-            _out = tf.pad(out_seq, [(0, 0), (0, 1)])
-            dec_attn_mask = trans._make_dec_attn_mask(_out)[:, :, -1:, :]  # [1, 1, n_q=1, n_kv]
+            cur_len = tf.shape(out_seq)[1] + 1
+            dec_attn_mask = trans._make_causal_mask(cur_len, num_queries=1)  # [1, 1, n_q=1, n_kv]
+            dec_attn_bias = trans._make_attn_bias(dec_attn_mask)
+            enc_attn_bias = trans._make_attn_bias(enc_attn_mask)
 
-            new_dec_layers = []
             new_dec_dec_kv = []
 
             for layer in range(trans.num_layers_dec):
                 # multi-head self-attention: use only the newest time-step as query,
                 # but all time-steps up to newest one as keys/values
-                next_dec_kv = trans.dec_attn[layer].kv_conv(trans.dec_attn[layer].preprocess(dec_inp_t))
-                new_dec_dec_kv.append(tf.concat([dec_dec_kv[layer], next_dec_kv], axis=1))
-                dec_inp_t = trans.dec_attn[layer](dec_inp_t, dec_attn_mask, kv=new_dec_dec_kv[layer])
-
-                dec_inp_t = trans.dec_enc_attn[layer](dec_inp_t, enc_attn_mask, kv=dec_enc_kv[layer])
+                # keys/values are cached split into heads, so that we only transpose the newest time-step
+                next_k, next_v = trans.dec_attn[layer].split_kv(
+                    trans.dec_attn[layer].kv_conv(trans.dec_attn[layer].preprocess(dec_inp_t)))
+                prev_k, prev_v = dec_dec_kv[layer]
+                new_dec_dec_kv.append((tf.concat([prev_k, next_k], axis=2), tf.concat([prev_v, next_v], axis=2)))
+                dec_inp_t = trans.dec_attn[layer](dec_inp_t, dec_attn_bias, kv=new_dec_dec_kv[layer])
+
+                dec_inp_t = trans.dec_enc_attn[layer](dec_inp_t, enc_attn_bias, kv=dec_enc_kv[layer])
                 dec_inp_t = trans.dec_ffn[layer](dec_inp_t)
 
-                new_dec_inp = tf.concat([prev_dec_layers[layer], dec_inp_t], axis=1)
-                new_dec_layers.append(new_dec_inp)
-
             if trans.normalize_out:
                 dec_inp_t = trans.dec_out_norm(dec_inp_t)
 
-            rdo = dec_inp_t[:, -1]
+            rdo = tf.to_float(dec_inp_t[:, -1])
 
             new_state = self.DecState(enc_out, enc_attn_mask, attnP, rdo, out_seq, offset + 1,
-                                      new_emb, new_dec_layers, dec_enc_kv, new_dec_dec_kv)
+                                      dec_enc_kv, new_dec_dec_kv)
             return new_state
 
     def get_rdo(self, dec_state, **kwargs):
@@ -14,7 +14,7 @@ class FFN:
     """
     def __init__(self, name,
                  inp_size, hid_size, out_size,
-                 relu_dropout):
+                 relu_dropout, dtype=tf.float32):
         self.name = name
         self.relu_dropout = relu_dropout
 
@@ -23,13 +23,15 @@ class FFN:
                 'conv1',
                 inp_size, hid_size,
                 activation=tf.nn.relu,
-                b=tf.zeros_initializer())
+                b=tf.zeros_initializer(),
+                dtype=dtype)
 
             self.second_conv = Dense(
                 'conv2',
                 hid_size, out_size,
                 activation=lambda x: x,
-                b=tf.zeros_initializer())
+                b=tf.zeros_initializer(),
+                dtype=dtype)
 
     def __call__(self, inputs, params_summary=None):
         """
@@ -38,15 +40,60 @@ class FFN:
         out: [batch_size * ninp * out_dim]
         """
         with tf.variable_scope(self.name):
-            hidden = self.first_conv(inputs)
-            if is_dropout_enabled():
-                hidden = tf.nn.dropout(hidden, 1.0 - self.relu_dropout)
-
+            hidden = _bias_relu_dropout(dot(inputs, self.first_conv.W), self.first_conv.b, self.relu_dropout)
             outputs = self.second_conv(hidden)
+            outputs.set_shape(inputs.shape[:-1].concatenate(outputs.shape[-1:]))  # dot() loses static ninp
 
             return outputs
 
 
+def _bias_relu_dropout(x, bias, relu_dropout):
+    """
+    Bias-add, relu and dropout after the first FFN matmul, fused by XLA into a single kernel
+    when called under jit_scope (see Transformer use_xla)
+    x: [..., hid_dim], pre-activation without bias
+    bias: [hid_dim]
+    """
+    hidden = tf.nn.relu(x + bias)
+    if is_dropout_enabled():
+        hidden = tf.nn.dropout(hidden, 1.0 - relu_dropout)
+    return hidden
+
+
+def _masked_softmax_dropout(logits, attn_bias, attn_dropout):
+    """
+    Bias-add, softmax and dropout over attention logits, fused by XLA into a single kernel
+    when called under jit_scope
+    Softmax is computed in float32, weights have the same dtype as logits
+    logits: [batch_size * n_heads * n_q * n_kv]
+    attn_bias: [batch_size * 1 * n_q * n_kv]
+    """
+    weights = tf.cast(tf.nn.softmax(tf.to_float(logits) + attn_bias), logits.dtype)
+    weights.set_shape(logits.shape)  # attn_bias broadcasts to logits, static n_q must not get lost
+    if is_dropout_enabled():
+        weights = tf.nn.dropout(weights, 1.0 - attn_dropout)
+    return weights
+
+
+def _attention_transpose(x, perm):
+    """
+    Transposes attention heads to/from (batch_size * n_heads * ninp * depth) layout.
+    Under jit_scope (see Transformer use_xla), XLA lowers such batched "swap two outer axes"
+    transposes into a tiled shared-memory kernel instead of generic tf.transpose.
+    Dimensions of static size 1 are ignored: if the remaining ones keep their order (e.g. a single
+    decoding step with ninp == 1), the transpose is just a reshape and no data is moved
+    """
+    if x.shape.ndims is None:
+        return tf.transpose(x, perm)
+    static_shape = x.shape.as_list()
+    moved_axes = [axis for axis in perm if static_shape[axis] != 1]
+    if moved_axes != sorted(moved_axes):
+        return tf.transpose(x, perm)
+    ret = tf.reshape(x, tf.gather(tf.shape(x), perm))
+    ret.set_shape([static_shape[axis] for axis in perm])
+    return ret
+
+
 class MultiHeadAttn:
     """
     Multihead scaled-dot-product attention with input/output transformations
@@ -56,7 +103,7 @@ class MultiHeadAttn:
     def __init__(
         self, name, inp_size,
         key_depth, value_depth, output_depth,
-        num_heads, attn_dropout, attn_value_dropout, debug=False, _format='combined'
+        num_heads, attn_dropout, attn_value_dropout, debug=False, _format='combined', dtype=tf.float32
     ):
         self.name = name
         self.key_depth = key_depth
@@ -67,6 +114,9 @@ class MultiHeadAttn:
         self.debug = debug
         self.format = _format
 
+        # 1/sqrt(key depth per head) is folded into the query projection instead of dividing q
+        q_scale = (key_depth / num_heads) ** -.5
+
         with tf.variable_scope(name):
             self.scope = tf.get_variable_scope()
 
@@ -76,13 +126,17 @@ class MultiHeadAttn:
                     inp_size, key_depth,
                     activation=lambda x: x,
                     b=tf.zeros_initializer(),
+                    dtype=dtype,
                 )
+                self.query_conv.W *= q_scale
+                self.query_conv.b *= q_scale
 
                 self.kv_conv = Dense(
                     'mem_conv',
                     inp_size, key_depth + value_depth,
                     activation=lambda x: x,
                     b=tf.zeros_initializer(),
+                    dtype=dtype,
                 )
 
                 self.combined_conv = Dense(
@@ -98,7 +152,11 @@ class MultiHeadAttn:
                     'mem_conv',  # old name for compatibility
                     inp_size, key_depth * 2 + value_depth,
                     activation=lambda x: x,
-                    b=tf.zeros_initializer())
+                    b=tf.zeros_initializer(),
+                    dtype=dtype)
+                W, b = self.combined_conv.W, self.combined_conv.b
+                self.combined_conv.W = tf.concat([W[:, :key_depth] * q_scale, W[:, key_depth:]], axis=1)
+                self.combined_conv.b = tf.concat([b[:key_depth] * q_scale, b[key_depth:]], axis=0)
 
                 self.query_conv = Dense(
                     'query_conv',
@@ -122,46 +180,41 @@ class MultiHeadAttn:
                 'out_conv',
                 value_depth, output_depth,
                 activation=lambda x: x,
-                b=tf.zeros_initializer())
+                b=tf.zeros_initializer(),
+                dtype=dtype)
 
-    def __call__(self, query_inp, attn_mask, kv_inp=None, kv=None):
+    def __call__(self, query_inp, attn_bias, kv_inp=None, kv=None):
         """
         query_inp: [batch_size * n_q * inp_dim]
-        attn_mask: [batch_size * 1 * n_q * n_kv]
+        attn_bias: [batch_size * 1 * n_q * n_kv], see Transformer._make_attn_bias
         kv_inp: [batch_size * n_kv * inp_dim]
+        kv: precomputed keys and values, already split into heads, see split_kv
         -----------------------------------------------
         results: [batch_size * n_q * output_depth]
         """
         assert kv is None or kv_inp is None, "please only feed one of kv or kv_inp"
         with tf.name_scope(self.name) as scope:
+            # q: [batch_size * n_heads * n_q * (k_dim/n_heads)]
+            # k: [batch_size * n_heads * n_kv * (k_dim/n_heads)]
+            # v: [batch_size * n_heads * n_kv * (v_dim/n_heads)]
             if kv_inp is not None or kv is not None:
                 q = self.query_conv(query_inp)
+                q.set_shape(query_inp.shape[:-1].concatenate(q.shape[-1:]))  # keep static n_q, e.g. 1 when decoding
+                q = self._split_heads(q)
                 if kv is None:
-                    kv = self.kv_conv(kv_inp)
-                k, v = tf.split(kv, [self.key_depth, self.value_depth], axis=2)
+                    kv = self.split_kv(self.kv_conv(kv_inp))
+                k, v = kv
             else:
                 combined = self.combined_conv(query_inp)
-                q, k, v = tf.split(combined, [self.key_depth, self.key_depth, self.value_depth], axis=2)
-            q = self._split_heads(q)  # [batch_size * n_heads * n_q * (k_dim/n_heads)]
-            k = self._split_heads(k)  # [batch_size * n_heads * n_kv * (k_dim/n_heads)]
-            v = self._split_heads(v)  # [batch_size * n_heads * n_kv * (v_dim/n_heads)]
-
-            key_depth_per_head = self.key_depth / self.num_heads
-            q = q / math.sqrt(key_depth_per_head)
+                q, k, v = self._split_heads_fused(combined, [self.key_depth, self.key_depth, self.value_depth])
 
             # Dot-product attention
             # logits: (batch_size * n_heads * n_q * n_kv)
-            attn_bias = MultiHeadAttn.ATTN_BIAS_VALUE * (1 - attn_mask)
-            logits = tf.matmul(
-                tf.transpose(q, perm=[0, 1, 2, 3]),
-                tf.transpose(k, perm=[0, 1, 3, 2])) + attn_bias
-            weights = tf.nn.softmax(logits)
-
-            if is_dropout_enabled():
-                weights = tf.nn.dropout(weights, 1.0 - self.attn_dropout)
+            logits = tf.matmul(q, k, transpose_b=True)
+            weights = _masked_softmax_dropout(logits, attn_bias, self.attn_dropout)
             x = tf.matmul(
-                weights,                         # [batch_size * n_heads * n_q * n_kv]
-                tf.transpose(v, perm=[0, 1, 2, 3])  # [batch_size * n_heads * n_kv * (v_deph/n_heads)]
+                weights,  # [batch_size * n_heads * n_q * n_kv]
+                v         # [batch_size * n_heads * n_kv * (v_deph/n_heads)]
             )
             combined_x = self._combine_heads(x)
 
@@ -169,8 +222,20 @@ class MultiHeadAttn:
                 combined_x = tf.nn.dropout(combined_x, 1.0 - self.attn_value_dropout)
 
             outputs = self.out_conv(combined_x)
+            outputs.set_shape(query_inp.shape[:-1].concatenate(outputs.shape[-1:]))
             return outputs
 
+    def split_kv(self, kv):
+        """
+        Split keys and values into heads, e.g. to cache them between decoding steps
+        input: (batch_size * n_kv * (k_dim + v_dim)), e.g. kv_conv(kv_inp)
+        output: tuple of keys (batch_size * n_heads * n_kv * (k_dim/n_heads))
+                and values (batch_size * n_heads * n_kv * (v_dim/n_heads))
+        Decoding steps extend these caches with one concat per layer: layer i+1 needs layer i's output first,
+        and stacking the caches of all layers into one tensor would copy every one of them again
+        """
+        return tuple(self._split_heads_fused(kv, [self.key_depth, self.value_depth]))
+
     def _split_heads(self, x):
         """
         Split channels (dimension 3) into multiple heads (dimension 1)
@@ -182,7 +247,24 @@ class MultiHeadAttn:
         new_shape = old_shape[:-1] + [self.num_heads] + [dim_size // self.num_heads if dim_size else None]
         ret = tf.reshape(x, tf.concat([tf.shape(x)[:-1], [self.num_heads, -1]], 0))
         ret.set_shape(new_shape)
-        return tf.transpose(ret, [0, 2, 1, 3])  # [batch_size * n_heads * ninp * (hid_dim//n_heads)]
+        return _attention_transpose(ret, [0, 2, 1, 3])  # [batch_size * n_heads * ninp * (hid_dim//n_heads)]
+
+    def _split_heads_fused(self, x, depths):
+        """
+        Split fused projection (e.g. q, k and v) into parts and each part into heads with a single transpose
+        input: (batch_size * ninp * sum(depths))
+        output: list of (batch_size * n_heads * ninp * (depth/n_heads)), one for each depth
+        """
+        if len(set(depths)) != 1:
+            return [self._split_heads(part) for part in tf.split(x, depths, axis=2)]
+
+        num_parts, depth_per_head = len(depths), depths[0] // self.num_heads
+        ret = tf.reshape(x, tf.concat([tf.shape(x)[:-1], [num_parts, self.num_heads, depth_per_head]], 0))
+        ret = _attention_transpose(ret, [2, 0, 3, 1, 4])  # [num_parts * batch_size * n_heads * ninp * depth_per_head]
+        parts = tf.unstack(ret, num=num_parts, axis=0)
+        for part in parts:
+            part.set_shape([None, self.num_heads, None, depth_per_head])
+        return parts
 
     def _combine_heads(self, x):
         """
@@ -190,13 +272,12 @@ class MultiHeadAttn:
         input: (batch_size * n_heads * ninp * (inp_dim/n_heads))
         out: (batch_size * ninp * inp_dim)
         """
-        x = tf.transpose(x, [0, 2, 1, 3])
+        x = _attention_transpose(x, [0, 2, 1, 3])
         old_shape = x.get_shape().dims
         a, b = old_shape[-2:]
         new_shape = old_shape[:-2] + [a * b if a and b else None]
         ret = tf.reshape(x, tf.concat([tf.shape(x)[:-2], [-1]], 0))
         ret.set_shape(new_shape)
-        ret = tf.transpose(ret, perm=[0, 1, 2])
         return ret
 
 
@@ -213,7 +294,8 @@ class Transformer:
             attn_dropout=0.0, attn_value_dropout=0.0, relu_dropout=0.0, res_dropout=0.1,
             debug=None, share_emb=False, inp_emb_bias=False, rescale_emb=False,
             dst_reverse=False, dst_rand_offset=False,
-            res_steps='ldan', normalize_out=False, multihead_attn_format='v1', **_kwargs
+            res_steps='ldan', normalize_out=False, multihead_attn_format='v1',
+            max_len=1024, use_xla=False, compute_dtype='float32', **_kwargs
     ):
 
         if isinstance(ff_size, str):
@@ -240,8 +322,20 @@ class Transformer:
         self.dst_reverse = dst_reverse
         self.dst_rand_offset = dst_rand_offset
         self.normalize_out = normalize_out
+        self.max_len = max_len
+        self.use_xla = use_xla
+        # variables are always float32, activations are cast to compute_dtype (e.g. float16)
+        # float16 training also needs static loss scaling, see loss_scale in src.training_utils.compute_gradients
+        self.compute_dtype = tf.as_dtype(compute_dtype)
 
         with tf.variable_scope(name):
+            # timing signal only depends on position, precompute it for positions [0, max_len)
+            self._timing_signal = tf.constant(self._get_timing_signal(max_len, emb_size), name='timing_signal')
+            self._timing_sin_mask = tf.constant(
+                [1.0] * (emb_size // 2) + [0.0] * (emb_size - emb_size // 2), name='timing_sin_mask')
+            # lower-triangular decoder mask, sliced to actual output length
+            self._causal_mask = tf.constant(np.tril(np.ones([max_len, max_len], dtype=bool)), name='causal_mask')
+
             max_voc_size = max(len(inp_voc), len(out_voc))
             self.emb_inp = Embedding(
                 'emb_inp', max_voc_size if share_emb else len(inp_voc), emb_size,
@@ -271,7 +365,8 @@ class Transformer:
                     num_heads=num_heads,
                     attn_dropout=attn_dropout,
                     attn_value_dropout=attn_value_dropout,
-                    debug=debug),
+                    debug=debug,
+                    dtype=self.compute_dtype),
                 inp_size=emb_size if i == 0 else hid_size,
                 out_size=emb_size if i == 0 else hid_size,
                 steps=res_steps,
@@ -285,7 +380,8 @@ class Transformer:
                     inp_size=emb_size if i == 0 else hid_size,
                     hid_size=ff_size if ff_size else (inner_hid_size if inner_hid_size else hid_size),
                     out_size=hid_size,
-                    relu_dropout=relu_dropout),
+                    relu_dropout=relu_dropout,
+                    dtype=self.compute_dtype),
                 inp_size=emb_size if i == 0 else hid_size,
                 out_size=hid_size,
                 steps=res_steps,
@@ -307,7 +403,8 @@ class Transformer:
                     num_heads=num_heads,
                     attn_dropout=attn_dropout,
                     attn_value_dropout=attn_value_dropout,
-                    debug=debug),
+                    debug=debug,
+                    dtype=self.compute_dtype),
                 inp_size=emb_size if i == 0 else hid_size,
                 out_size=emb_size if i == 0 else hid_size,
                 steps=res_steps,
@@ -327,6 +424,7 @@ class Transformer:
                     attn_value_dropout=attn_value_dropout,
                     debug=debug,
                     _format='use_kv' if multihead_attn_format == 'v1' else 'combined',
+                    dtype=self.compute_dtype,
                 ),
                 inp_size=emb_size if i == 0 else hid_size,
                 out_size=emb_size if i == 0 else hid_size,
@@ -341,7 +439,8 @@ class Transformer:
                     inp_size=emb_size if i == 0 else hid_size,
                     hid_size=ff_size if ff_size else hid_size,
                     out_size=hid_size,
-                    relu_dropout=relu_dropout),
+                    relu_dropout=relu_dropout,
+                    dtype=self.compute_dtype),
                 inp_size=emb_size if i == 0 else hid_size,
                 out_size=hid_size,
                 steps=res_steps,
@@ -351,8 +450,15 @@ class Transformer:
             if self.normalize_out:
                 self.dec_out_norm = LayerNorm('dec_out_norm', inp_size=emb_size if self.num_layers_dec == 0 else hid_size)
 
+            # kv projections of all decoder-encoder attention layers stacked into one matrix, see _make_dec_enc_kv
+            self._dec_enc_kv_W = self._dec_enc_kv_b = None
+            kv_convs = [layer.kv_conv for layer in self.dec_enc_attn]
+            if kv_convs and len(set(tuple(conv.W.shape.as_list()) for conv in kv_convs)) == 1:
+                self._dec_enc_kv_W = tf.concat([conv.W for conv in kv_convs], axis=1)
+                self._dec_enc_kv_b = tf.concat([conv.b for conv in kv_convs], axis=0)
+
     def encode(self, inp, inp_len, is_train):
-        with dropout_scope(is_train), tf.name_scope(self.name + '_enc') as scope:
+        with dropout_scope(is_train), jit_scope(self.use_xla), tf.name_scope(self.name + '_enc') as scope:
 
             # Embeddings
             emb_inp = self.emb_inp(inp)  # [batch_size * ninp * emb_dim]
@@ -362,8 +468,9 @@ class Transformer:
 
             # Prepare decoder
             enc_attn_mask = self._make_enc_attn_mask(inp, inp_len)  # [batch_size * 1 * 1 * ninp]
+            enc_attn_bias = self._make_attn_bias(enc_attn_mask)
 
-            enc_inp = self._add_timing_signal(emb_inp)
+            enc_inp = tf.cast(self._add_timing_signal(emb_inp), self.compute_dtype)
 
             # Apply dropouts
             if is_dropout_enabled():
@@ -371,7 +478,7 @@ class Transformer:
 
             # Encoder
             for layer in range(self.num_layers_enc):
-                enc_inp = self.enc_attn[layer](enc_inp, enc_attn_mask)
+                enc_inp = self.enc_attn[layer](enc_inp, enc_attn_bias)
                 enc_inp = self.enc_ffn[layer](enc_inp)
 
             if self.normalize_out:
@@ -382,7 +489,7 @@ class Transformer:
             return enc_out, enc_attn_mask
 
     def decode(self, out, out_len, out_reverse, enc_out, enc_attn_mask, is_train):
-        with dropout_scope(is_train), tf.name_scope(self.name + '_dec') as scope:
+        with dropout_scope(is_train), jit_scope(self.use_xla), tf.name_scope(self.name + '_dec') as scope:
             # Embeddings
             emb_out = self.emb_out(out)  # [batch_size * nout * emb_dim]
             if self.rescale_emb:
@@ -393,9 +500,12 @@ class Transformer:
 
             # Prepare decoder
             dec_attn_mask = self._make_dec_attn_mask(out)  # [1 * 1 * nout * nout]
+            dec_attn_bias = self._make_attn_bias(dec_attn_mask)
+            enc_attn_bias = self._make_attn_bias(enc_attn_mask)
 
             offset = 'random' if self.dst_rand_offset else 0
-            dec_inp = self._add_timing_signal(emb_out, offset=offset, inp_reverse=out_reverse)
+            dec_inp = tf.cast(self._add_timing_signal(emb_out, offset=offset, inp_reverse=out_reverse),
+                              self.compute_dtype)
             # Apply dropouts
             if is_dropout_enabled():
                 dec_inp = tf.nn.dropout(dec_inp, 1.0 - self.res_dropout)
@@ -403,26 +513,28 @@ class Transformer:
             # bypass info from Encoder to avoid None gradients for num_layers_dec == 0
             if self.num_layers_dec == 0:
                 inp_mask = tf.squeeze(tf.transpose(enc_attn_mask, perm=[3,1,2,0]),3)
-                dec_inp += tf.reduce_mean(enc_out * inp_mask, axis=[0,1], keep_dims=True)
+                dec_inp += tf.reduce_mean(enc_out * tf.cast(inp_mask, enc_out.dtype), axis=[0,1], keep_dims=True)
 
             # Decoder
+            dec_enc_kv = self._make_dec_enc_kv(enc_out)
             for layer in range(self.num_layers_dec):
-                dec_inp = self.dec_attn[layer](dec_inp, dec_attn_mask)
-                dec_inp = self.dec_enc_attn[layer](dec_inp, enc_attn_mask, enc_out)
+                dec_inp = self.dec_attn[layer](dec_inp, dec_attn_bias)
+                dec_inp = self.dec_enc_attn[layer](dec_inp, enc_attn_bias, kv=dec_enc_kv[layer])
                 dec_inp = self.dec_ffn[layer](dec_inp)
 
             if self.normalize_out:
                 dec_inp = self.dec_out_norm(dec_inp)
 
-            dec_out = dec_inp
+            dec_out = tf.to_float(dec_inp)
             return dec_out
 
-    def _make_enc_attn_mask(self, inp, inp_len, dtype=tf.float32):
+    def _make_enc_attn_mask(self, inp, inp_len, dtype=tf.bool):
         """
         inp = [batch_size * ninp]
         inp_len = [batch_size]
 
-        attn_mask = [batch_size * 1 * 1 * ninp]
+        attn_mask = [batch_size * 1 * 1 * ninp], boolean by default: it is carried in the decoder state
+        and only turned into a float bias once per encode/decode, see _make_attn_bias
         """
         with tf.variable_scope("make_enc_attn_mask"):
             inp_mask = tf.sequence_mask(inp_len, dtype=dtype, maxlen=tf.shape(inp)[1])
@@ -430,7 +542,41 @@ class Transformer:
             attn_mask = inp_mask[:, None, None, :]
             return attn_mask
 
-    def _make_dec_attn_mask(self, out, dtype=tf.float32):
+    def _make_dec_enc_kv(self, enc_out):
+        """
+        Projects encoder outputs into keys and values for every decoder-encoder attention layer.
+        Note: we do not preprocess enc_out for each layer because ResidualLayerWrapper
+        only preprocesses first input (query)
+
+        enc_out = [batch_size * ninp * hid_dim]
+
+        dec_enc_kv = list of (keys, values) for each decoder layer, see MultiHeadAttn.split_kv
+        """
+        with tf.variable_scope("make_dec_enc_kv"):
+            if self._dec_enc_kv_W is None:
+                return [layer.split_kv(layer.kv_conv(enc_out)) for layer in self.dec_enc_attn]
+
+            # one matmul and one transpose for all layers instead of one per layer
+            attn = self.dec_enc_attn[0]
+            kv = dot(enc_out, self._dec_enc_kv_W) + self._dec_enc_kv_b
+            keys_and_values = attn._split_heads_fused(kv, [attn.key_depth, attn.value_depth] * self.num_layers_dec)
+            return list(zip(keys_and_values[0::2], keys_and_values[1::2]))
+
+    def _make_attn_bias(self, attn_mask):
+        """
+        attn_mask = [batch_size * 1 * n_q * n_kv], True/1 for positions that can be attended to, False/0 otherwise
+
+        attn_bias = [batch_size * 1 * n_q * n_kv], float32, added to attention logits.
+        Computed once per encode/decode and shared by all layers.
+        Softmax always runs in float32 (see _masked_softmax_dropout), so the bias is safe for any compute_dtype
+        """
+        with tf.variable_scope("make_attn_bias"):
+            is_visible = attn_mask if attn_mask.dtype == tf.bool else attn_mask > 0
+            return tf.where(is_visible,
+                            tf.zeros(tf.shape(attn_mask)),
+                            tf.fill(tf.shape(attn_mask), MultiHeadAttn.ATTN_BIAS_VALUE))
+
+    def _make_dec_attn_mask(self, out, dtype=tf.bool):
         """
         out = [baatch_size * nout]
 
@@ -438,10 +584,26 @@ class Transformer:
         """
         with tf.variable_scope("make_dec_attn_mask"):
             length = tf.shape(out)[1]
-            lower_triangle = tf.matrix_band_part(tf.ones([length, length], dtype=dtype), -1, 0)
-            attn_mask = tf.reshape(lower_triangle, [1, 1, length, length])
+            attn_mask = tf.cast(self._make_causal_mask(length), dtype)
             return attn_mask
 
+    def _make_causal_mask(self, length, num_queries=None):
+        """
+        Lower-triangular mask for the last num_queries (by default, all) of length positions.
+        Sliced from the precomputed table if length <= max_len, computed otherwise
+
+        attn_mask = [1 * 1 * num_queries * length], bool
+        """
+        num_queries = length if num_queries is None else num_queries
+
+        def table_mask():
+            return self._causal_mask[length - num_queries:length, :length]
+
+        def computed_mask():
+            return tf.range(length)[None, :] <= tf.range(length - num_queries, length)[:, None]
+
+        return tf.cond(length <= self.max_len, table_mask, computed_mask)[None, None]
+
     def _add_timing_signal(self, inp, min_timescale=1.0, max_timescale=1.0e4, offset=0, inp_reverse=None):
         """
         inp: (batch_size * ninp * hid_dim)
@@ -451,44 +613,101 @@ class Transformer:
         """
         with tf.variable_scope("add_timing_signal"):
             ninp = tf.shape(inp)[1]
-            hid_size = tf.shape(inp)[2]
-
-            position = tf.to_float(tf.range(ninp))[None, :, None]
 
-            if offset == 'random':
-                BIG_LEN = 32000
-                offset = tf.random_uniform(tf.shape(position), minval=-BIG_LEN, maxval=BIG_LEN, dtype=tf.int32)
+            if offset == 'random' or self.dst_rand_offset or (min_timescale, max_timescale) != (1.0, 1.0e4):
+                return inp + self._compute_timing_signal(inp, min_timescale, max_timescale, offset, inp_reverse)
 
-            # force broadcasting over batch axis
             if isinstance(offset * 1, tf.Tensor):  # multiply by 1 to also select variables, special generators, etc.
                 assert offset.shape.ndims in (0, 1, 2)
                 new_shape = [tf.shape(offset)[i] for i in range(offset.shape.ndims)]
-                new_shape += [1] * (3 - len(new_shape))
-                offset = tf.reshape(offset, new_shape)
-
-            position += tf.to_float(offset)
-
-            if inp_reverse is not None:
-                position = tf.multiply(
-                    position,
-                    tf.where(
+                new_shape += [1] * (2 - len(new_shape))
+                position = tf.range(ninp)[None, :] + tf.to_int32(tf.reshape(offset, new_shape))
+                in_table = tf.logical_and(tf.reduce_min(position) >= 0, tf.reduce_max(position) < self.max_len)
+                lookup = lambda: tf.gather(self._timing_signal, position)
+            elif offset >= 0:
+                in_table = offset + ninp <= self.max_len
+                lookup = lambda: self._timing_signal[None, offset:offset + ninp]
+            else:
+                return inp + self._compute_timing_signal(inp, min_timescale, max_timescale, offset, inp_reverse)
+
+            def table_signal():
+                # positions are in [0, max_len): look timing signal up in a precomputed table
+                signal = lookup()
+                if inp_reverse is not None:
+                    # reversed positions are negative: sin changes sign, cos does not
+                    sign = tf.where(
                         tf.equal(inp_reverse, 0),
                         tf.ones_like(inp_reverse, dtype=tf.float32),
                         -1.0 * tf.ones_like(inp_reverse, dtype=tf.float32)
-                    )[:, None, None]  # (batch_size * ninp * dim)
-                )
-            num_timescales = hid_size // 2
-            log_timescale_increment = (
-                math.log(float(max_timescale) / float(min_timescale)) /
-                (tf.to_float(num_timescales) - 1))
-            inv_timescales = min_timescale * tf.exp(
-                tf.to_float(tf.range(num_timescales)) * -log_timescale_increment)
+                    )[:, None, None]
+                    signal *= 1.0 + (sign - 1.0) * self._timing_sin_mask
+                return signal
+
+            def computed_signal():
+                return self._compute_timing_signal(inp, min_timescale, max_timescale, offset, inp_reverse)
 
-            # scaled_time: [ninp * hid_dim]
-            scaled_time = position * inv_timescales[None, None, :]
-            signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=-1)
-            signal = tf.pad(signal, [[0, 0], [0, 0], [0, tf.mod(hid_size, 2)]])
-            return inp + signal
+            return inp + tf.cond(in_table, table_signal, computed_signal)
+
+    def _compute_timing_signal(self, inp, min_timescale=1.0, max_timescale=1.0e4, offset=0, inp_reverse=None):
+        """
+        Computes timing signal for arbitrary (e.g. random or negative) positions, see _add_timing_signal
+        signal: (batch_size * ninp * hid_dim)
+        """
+        ninp = tf.shape(inp)[1]
+        hid_size = tf.shape(inp)[2]
+
+        position = tf.to_float(tf.range(ninp))[None, :, None]
+
+        if offset == 'random':
+            BIG_LEN = 32000
+            with jit_scope(False):  # integer random_uniform has no XLA kernel
+                offset = tf.random_uniform(tf.shape(position), minval=-BIG_LEN, maxval=BIG_LEN, dtype=tf.int32)
+
+        # force broadcasting over batch axis
+        if isinstance(offset * 1, tf.Tensor):  # multiply by 1 to also select variables, special generators, etc.
+            assert offset.shape.ndims in (0, 1, 2)
+            new_shape = [tf.shape(offset)[i] for i in range(offset.shape.ndims)]
+            new_shape += [1] * (3 - len(new_shape))
+            offset = tf.reshape(offset, new_shape)
+
+        position += tf.to_float(offset)
+
+        if inp_reverse is not None:
+            position = tf.multiply(
+                position,
+                tf.where(
+                    tf.equal(inp_reverse, 0),
+                    tf.ones_like(inp_reverse, dtype=tf.float32),
+                    -1.0 * tf.ones_like(inp_reverse, dtype=tf.float32)
+                )[:, None, None]  # (batch_size * ninp * dim)
+            )
+        num_timescales = hid_size // 2
+        log_timescale_increment = (
+            math.log(float(max_timescale) / float(min_timescale)) /
+            (tf.to_float(num_timescales) - 1))
+        inv_timescales = min_timescale * tf.exp(
+            tf.to_float(tf.range(num_timescales)) * -log_timescale_increment)
+
+        # scaled_time: [ninp * hid_dim]
+        scaled_time = position * inv_timescales[None, None, :]
+        signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=-1)
+        signal = tf.pad(signal, [[0, 0], [0, 0], [0, tf.mod(hid_size, 2)]])
+        return signal
+
+    @staticmethod
+    def _get_timing_signal(length, hid_size, min_timescale=1.0, max_timescale=1.0e4):
+        """
+        Same as _compute_timing_signal, but in numpy and for positions [0, length)
+        signal: (length * hid_size)
+        """
+        num_timescales = hid_size // 2
+        log_timescale_increment = math.log(float(max_timescale) / float(min_timescale)) / (num_timescales - 1)
+        inv_timescales = min_timescale * np.exp(np.arange(num_timescales) * -log_timescale_increment)
+
+        scaled_time = np.arange(length)[:, None] * inv_timescales[None, :]
+        signal = np.concatenate([np.sin(scaled_time), np.cos(scaled_time),
+                                 np.zeros([length, hid_size % 2])], axis=1)
+        return signal.astype(np.float32)
 
 
 # ============================================================================
@@ -497,7 +716,7 @@ class Transformer:
 class Model(TranslateModel):
 
     DecState = namedtuple("transformer_state", ['enc_out', 'enc_attn_mask', 'attnP', 'rdo', 'out_seq', 'offset',
-                                                'emb', 'dec_layers', 'dec_enc_kv', 'dec_dec_kv'])
+                                                'dec_enc_kv', 'dec_dec_kv'])
 
     def __init__(self, name, inp_voc, out_voc, **hp):
         self.name = name
@@ -537,7 +756,7 @@ class Model(TranslateModel):
         """
         inp = batch['inp']
         inp_len = batch.get('inp_len', infer_length(inp, self.inp_voc.eos, time_major=False))
-        with dropout_scope(is_train), tf.name_scope(self.transformer.name):
+        with dropout_scope(is_train), jit_scope(self.transformer.use_xla), tf.name_scope(self.transformer.name):
             if self.debug:
                 inp = tf.Print(inp, [tf.shape(inp), inp], message="encode(): inp", first_n=100, summarize=100)
 
@@ -549,30 +768,30 @@ class Model(TranslateModel):
             batch_size = tf.shape(inp)[0]
             hid_size = tf.shape(enc_out)[-1]
             out_seq = tf.zeros([batch_size, 0], dtype=inp.dtype)
-            rdo = tf.zeros([batch_size, hid_size], dtype=enc_out.dtype)
+            rdo = tf.zeros([batch_size, hid_size], dtype=tf.float32)
 
             attnP = tf.ones([batch_size, ninp]) / tf.to_float(inp_len)[:, None]
 
             offset = tf.zeros((batch_size,))
             if self.transformer.dst_rand_offset:
                 BIG_LEN = 32000
-                random_offset = tf.random_uniform(tf.shape(offset), minval=-BIG_LEN, maxval=BIG_LEN, dtype=tf.int32)
+                with jit_scope(False):  # integer random_uniform has no XLA kernel
+                    random_offset = tf.random_uniform(tf.shape(offset), minval=-BIG_LEN, maxval=BIG_LEN,
+                                                      dtype=tf.int32)
                 offset += tf.to_float(random_offset)
 
             trans = self.transformer
-            empty_emb = tf.zeros([batch_size, 0, trans.emb_size])
-            empty_dec_layers = [tf.zeros([batch_size, 0, trans.hid_size])] * trans.num_layers_dec
-            input_layers = [empty_emb] + empty_dec_layers[:-1]
-
-            #prepare kv parts for all decoder attention layers. Note: we do not preprocess enc_out
-            # for each layer because ResidualLayerWrapper only preprocesses first input (query)
-            dec_enc_kv = [layer.kv_conv(enc_out)
-                          for i, layer in enumerate(trans.dec_enc_attn)]
-            dec_dec_kv = [layer.kv_conv(layer.preprocess(input_layers[i]))
-                          for i, layer in enumerate(trans.dec_attn)]
+            # prepare kv parts for all decoder attention layers
+            dec_enc_kv = trans._make_dec_enc_kv(enc_out)
+            # self-attention cache is empty before the first step, no need to project anything
+            dec_dec_kv = [(tf.zeros([batch_size, layer.num_heads, 0, layer.key_depth // layer.num_heads],
+                                    dtype=trans.compute_dtype),
+                           tf.zeros([batch_size, layer.num_heads, 0, layer.value_depth // layer.num_heads],
+                                    dtype=trans.compute_dtype))
+                          for layer in trans.dec_attn]
 
             new_state = self.DecState(enc_out, enc_attn_mask, attnP, rdo, out_seq, offset,
-                                      empty_emb, empty_dec_layers, dec_enc_kv, dec_dec_kv)
+                                      dec_enc_kv, dec_dec_kv)
 
             # perform initial decode (instead of force_bos) with zero embeddings
             new_state = self.decode(new_state, is_train=is_train)
@@ -587,8 +806,7 @@ class Model(TranslateModel):
         :param is_train: if True, enables dropouts
         """
         trans = self.transformer
-        enc_out, enc_attn_mask, attnP, rdo, out_seq, offset, prev_emb = dec_state[:7]
-        prev_dec_layers = dec_state.dec_layers
+        enc_out, enc_attn_mask, attnP, rdo, out_seq, offset = dec_state[:6]
         dec_enc_kv = dec_state.dec_enc_kv
         dec_dec_kv = dec_state.dec_dec_kv
 
@@ -596,7 +814,7 @@ class Model(TranslateModel):
         if words is not None:
             out_seq = tf.concat([out_seq, tf.expand_dims(words, 1)], 1)
 
-        with dropout_scope(is_train), tf.name_scope(trans.name):
+        with dropout_scope(is_train), jit_scope(trans.use_xla), tf.name_scope(trans.name):
             # Embeddings
             if words is None:
                 # initial step: words are None
@@ -607,7 +825,8 @@ class Model(TranslateModel):
                     emb_out *= trans.emb_size ** .5
 
             # Prepare decoder
-            dec_inp_t = trans._add_timing_signal(emb_out, offset=offset)
+            dec_inp_t = tf.cast(trans._add_timing_signal(emb_out, offset=offset), trans.compute_dtype)
+            dec_inp_t.set_shape([None, 1, None])  # a single time-step, see _attention_transpose
             # Apply dropouts
             if is_dropout_enabled():
                 dec_inp_t = tf.nn.dropout(dec_inp_t, 1.0 - trans.res_dropout)
@@ -615,36 +834,36 @@ class Model(TranslateModel):
             # bypass info from Encoder to avoid None gradients for num_layers_dec == 0
             if trans.num_layers_dec == 0:
                 inp_mask = tf.squeeze(tf.transpose(enc_attn_mask, perm=[3, 1, 2, 0]), 3)
-                dec_inp_t += tf.reduce_mean(enc_out * inp_mask, axis=[0, 1], keep_dims=True)
+                dec_inp_t += tf.reduce_mean(enc_out * tf.cast(inp_mask, enc_out.dtype), axis=[0, 1], keep_dims=True)
 
             # Decoder
-            new_emb = tf.concat([prev_emb, dec_inp_t], axis=1)
-            _out = tf.pad(out_seq, [(0, 0), (0, 1)])
-            dec_attn_mask = trans._make_dec_attn_mask(_out)[:, :, -1:, :]  # [1, 1, n_q=1, n_kv]
+            cur_len = tf.shape(out_seq)[1] + 1
+            dec_attn_mask = trans._make_causal_mask(cur_len, num_queries=1)  # [1, 1, n_q=1, n_kv]
+            dec_attn_bias = trans._make_attn_bias(dec_attn_mask)
+            enc_attn_bias = trans._make_attn_bias(enc_attn_mask)
 
-            new_dec_layers = []
             new_dec_dec_kv = []
 
             for layer in range(trans.num_layers_dec):
                 # multi-head self-attention: use only the newest time-step as query,
                 # but all time-steps up to newest one as keys/values
-                next_dec_kv = trans.dec_attn[layer].kv_conv(trans.dec_attn[layer].preprocess(dec_inp_t))
-                new_dec_dec_kv.append(tf.concat([dec_dec_kv[layer], next_dec_kv], axis=1))
-                dec_inp_t = trans.dec_attn[layer](dec_inp_t, dec_attn_mask, kv=new_dec_dec_kv[layer])
-
-                dec_inp_t = trans.dec_enc_attn[layer](dec_inp_t, enc_attn_mask, kv=dec_enc_kv[layer])
+                # keys/values are cached split into heads, so that we only transpose the newest time-step
+                next_k, next_v = trans.dec_attn[layer].split_kv(
+                    trans.dec_attn[layer].kv_conv(trans.dec_attn[layer].preprocess(dec_inp_t)))
+                prev_k, prev_v = dec_dec_kv[layer]
+                new_dec_dec_kv.append((tf.concat([prev_k, next_k], axis=2), tf.concat([prev_v, next_v], axis=2)))
+                dec_inp_t = trans.dec_attn[layer](dec_inp_t, dec_attn_bias, kv=new_dec_dec_kv[layer])
+
+                dec_inp_t = trans.dec_enc_attn[layer](dec_inp_t, enc_attn_bias, kv=dec_enc_kv[layer])
                 dec_inp_t = trans.dec_ffn[layer](dec_inp_t)
 
-                new_dec_inp = tf.concat([prev_dec_layers[layer], dec_inp_t], axis=1)
-                new_dec_layers.append(new_dec_inp)
-
             if trans.normalize_out:
                 dec_inp_t = trans.dec_out_norm(dec_inp_t)
 
-            rdo = dec_inp_t[:, -1]
+            rdo = tf.to_float(dec_inp_t[:, -1])
 
             new_state = self.DecState(enc_out, enc_attn_mask, attnP, rdo, out_seq, offset + 1,
-                                      new_emb, new_dec_layers, dec_enc_kv, new_dec_dec_kv)
+                                      dec_enc_kv, new_dec_dec_kv)
             return new_state
 
     def get_rdo(self, dec_state, **kwargs):
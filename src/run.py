@@ -1,16 +1,158 @@
+import io
 import os
+import sys
 import json
+import mmap
+import hashlib
+import time
+import tempfile
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import tensorflow as tf
 from tqdm import tqdm
-import matplotlib.pyplot as plt
-from pandas import ewma
 
 from vocab import Vocab
-from src.training_utils import *
-from lib.tensor_utils import infer_mask, initialize_uninitialized_variables
+from src.training_utils import create_model, create_session_config, iterate_minibatches
+from lib.tensor_utils import initialize_uninitialized_variables
+
+# bump whenever model or graph-building code changes: frozen graphs cached by older versions become stale
+GRAPH_CACHE_VERSION = 1
+
+# number of tokenized batches prepared in the background while the current one is translated
+PREFETCH_BATCHES = 2
+
+
+def build_frozen_translation_graph(model_name, inp_voc, out_voc, hp, model_path, session_config=None):
+    """
+    Creates model, loads its weights and freezes translation graph with weights as constants
+    :returns: GraphDef with input 'inp', int32[batch_size, ninp], and output 'translations', int32[batch_size, nout]
+    """
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(config=session_config) as sess:
+        model = create_model(model_name, inp_voc, out_voc, hp)
+        weights = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, model_name)
+
+        # Loading model state
+        with np.load(model_path) as w_values:
+            curr_var_names = set(w.name for w in weights)
+            var_names_in_file = set(w_values.keys())
+
+            if curr_var_names != var_names_in_file:
+                raise RuntimeError("Weights in %s do not match the model: missing %s, unexpected %s" % (
+                    model_path, sorted(curr_var_names - var_names_in_file)[:10],
+                    sorted(var_names_in_file - curr_var_names)[:10]))
+
+            # weights are fed rather than embedded into the graph as constants, one at a time:
+            # npz members are read on access, so only one weight array is in memory at once
+            placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in weights]
+            assigns = [tf.assign(var, ph) for var, ph in zip(weights, placeholders)]
+            for var, ph, assign in zip(weights, placeholders, assigns):
+                sess.run(assign.op, feed_dict={ph: w_values[var.name]})
+
+        assert model_name != 'gnmt', 'gnmt no longer supported'
+        with tf.device('/gpu:0'):  # keep beam search on the GPU, allow_soft_placement moves the rest
+            inp = tf.placeholder(tf.int32, [None, None], name='inp')
+            translations = model.symbolic_translate(inp, back_prop=False, swap_memory=True).best_out
+        with tf.device('/cpu:0'):
+            # device-to-host copy is a graph op issued as soon as best_out is ready, not at fetch time
+            tf.identity(translations, name='translations')
+
+        initialize_uninitialized_variables(sess)
+        graph.finalize()
+        return tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), ['translations'])
+
+
+def get_graph_cache_key(model_name, hp, *paths):
+    """ Hashes cache version, model name, hyperparameters and contents of files, e.g. model weights and vocabularies """
+    key = hashlib.sha256()
+    key.update(json.dumps([GRAPH_CACHE_VERSION, model_name, hp], sort_keys=True).encode('utf-8'))
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                key.update(chunk)
+    return key.hexdigest()
+
+
+def read_lines(path):
+    """ Lazily reads lines of a text file, without line breaks """
+    with io.open(path, 'r', encoding='utf-8', buffering=1 << 20) as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+def autotune_batch_size(sess, translations, inp, sample, candidates=(1, 2, 4, 8, 16, 32, 64, 128), n_iter=3):
+    """
+    Picks the inference batch size with the highest throughput, stops at the first one that runs out of memory
+    :param translations: tensor of translations computed from inp
+    :param inp: int32[batch_size, ninp], input tensor of the graph (gets fed directly)
+    :param sample: tokenized lines, int32[n, ninp], repeated to fill each candidate batch size
+    """
+    best_batch_size, best_throughput = candidates[0], 0
+    for batch_size in candidates:
+        batch = np.resize(sample, [batch_size, sample.shape[1]])
+        try:
+            sess.run(translations, {inp: batch})  # warm-up, e.g. XLA compilation for a new shape
+            start = time.time()
+            for _ in range(n_iter):
+                sess.run(translations, {inp: batch})
+        except tf.errors.ResourceExhaustedError:
+            break
+        throughput = batch_size * n_iter / (time.time() - start)
+        if throughput > best_throughput:
+            best_batch_size, best_throughput = batch_size, throughput
+    return best_batch_size
+
+
+def optimize_with_tensorrt(sess, fetches, max_batch_size, precision_mode='FP16', session_config=None):
+    """
+    Freezes the part of sess.graph needed for fetches, optimizes it with TF-TRT and imports it into a new graph
+    :param fetches: a list of tensors and ops to be computed by the optimized graph
+    :returns: a new session over the optimized graph and fetches from that graph
+    """
+    from tensorflow.contrib import tensorrt as trt  # requires tensorflow>=1.7 built with TensorRT
+
+    output_names = [fetch.op.name if isinstance(fetch, tf.Tensor) else fetch.name for fetch in fetches]
+    frozen_graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph_def, output_names)
+    # beam search tf.while_loop is not convertible and stays in TF, only the ops around it go to TensorRT
+    trt_graph_def = trt.create_inference_graph(
+        input_graph_def=frozen_graph_def, outputs=output_names,
+        max_batch_size=max_batch_size, max_workspace_size_bytes=1 << 30,
+        precision_mode=precision_mode, minimum_segment_size=3)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(trt_graph_def, name='')
+    return tf.Session(graph=graph, config=session_config), [graph.as_graph_element(fetch.name) for fetch in fetches]
+
+
+class SpilledLineWriter:
+    """
+    Appends lines, which arrive in any order, to a temporary binary file and keeps only their offsets in memory.
+    Once all lines are there, copy_to writes them into the output file in the order of their indices
+    """
+    def __init__(self, spill_file, num_lines):
+        self.spill_file = spill_file
+        self.starts = np.zeros(num_lines, dtype='int64')
+        self.ends = np.zeros(num_lines, dtype='int64')
+        self.size = 0
+
+    def write(self, indices, lines):
+        data = [line.encode('utf-8') for line in lines]
+        lengths = np.array([len(line) for line in data], dtype='int64')
+        self.ends[indices] = self.size + np.cumsum(lengths)
+        self.starts[indices] = self.ends[indices] - lengths
+        self.spill_file.write(b''.join(data))
+        self.size += int(lengths.sum())
+
+    def copy_to(self, output_file):
+        self.spill_file.flush()
+        spilled = mmap.mmap(self.spill_file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        for i, (start, end) in enumerate(zip(self.starts.tolist(), self.ends.tolist())):
+            output_file.write(spilled[start:end] if i == 0 else b'\n' + spilled[start:end])
+        if self.size:
+            spilled.close()
 
 
 def run_model(model_name, config):
@@ -19,49 +161,123 @@ def run_model(model_name, config):
     input_path = config.get('input_path')
     output_path = config.get('output_path')
 
-    src_data = open(input_path, 'r', encoding='utf-8').read().splitlines()
+    src_data = read_lines(input_path)  # consumed lazily by tokenization
 
-    inp_voc = Vocab.from_file('{}/1.voc'.format(config.get('data_path')))
-    out_voc = Vocab.from_file('{}/2.voc'.format(config.get('data_path')))
+    inp_voc_path = '{}/1.voc'.format(config.get('data_path'))
+    out_voc_path = '{}/2.voc'.format(config.get('data_path'))
+    inp_voc = Vocab.from_file(inp_voc_path)
+    out_voc = Vocab.from_file(out_voc_path)
 
     hp = json.load(open(config.get('hp_file_path'), 'r', encoding='utf-8')) if config.get('hp_file_path') else {}
-    gpu_options = create_gpu_options(config)
     max_len = config.get('max_input_len', 200)
 
-    with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
-        model = create_model(model_name, inp_voc, out_voc, hp)
-        weights = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, model_name)
+    session_config = create_session_config(config)
 
-        # Loading model state
-        w_values = np.load(config.get('model_path'))
-        curr_var_names = set(w.name for w in weights)
-        var_names_in_file = set(w_values.keys())
+    graph_cache_path = None
+    if config.get('graph_cache_dir'):
+        key = get_graph_cache_key(model_name, hp, config.get('model_path'), inp_voc_path, out_voc_path)
+        graph_cache_path = os.path.join(config.get('graph_cache_dir'), key + '.pb')
 
-        assert curr_var_names == var_names_in_file
+    if graph_cache_path and os.path.exists(graph_cache_path):
+        print('Loading frozen graph from %s' % graph_cache_path)
+        translation_graph_def = tf.GraphDef()
+        with open(graph_cache_path, 'rb') as f:
+            translation_graph_def.ParseFromString(f.read())
+    else:
+        translation_graph_def = build_frozen_translation_graph(
+            model_name, inp_voc, out_voc, hp, config.get('model_path'), session_config)
+        if graph_cache_path:
+            print('Saving frozen graph into %s' % graph_cache_path)
+            os.makedirs(config.get('graph_cache_dir'), exist_ok=True)
+            with open(graph_cache_path + '.tmp', 'wb') as f:
+                f.write(translation_graph_def.SerializeToString())
+            os.replace(graph_cache_path + '.tmp', graph_cache_path)
 
-        assigns = [tf.assign(var, tf.constant(w_values[var.name])) for var in weights]
-        sess.run(assigns)
+    with tf.Session(config=session_config) as sess:
+        print('Generating translations')
 
-        initialize_uninitialized_variables(sess)
+        # the whole input is tokenized at once; lines of similar length are translated together
+        # to avoid decoding padding, translations are restored to the original order afterwards
+        src_ix, src_len = inp_voc.tokenize_corpus(src_data, max_len=max_len)
+        order = np.argsort(src_len, kind='mergesort')
 
-        print('Generating translations')
-        inp = tf.placeholder(tf.int32, [None, None])
+        def tokenized_batches():
+            # batches are gathered into reused buffers. A buffer may only be overwritten once its batch has
+            # left the pipeline: at most PREFETCH_BATCHES are queued, plus one being translated
+            # and one being written by this generator
+            batch_size = config['batch_size_for_inference']
+            buffers = [np.empty(batch_size * src_ix.shape[1], dtype='int32') for _ in range(PREFETCH_BATCHES + 2)]
+            for i, (batch_ix,) in enumerate(iterate_minibatches(order, batchsize=batch_size)):
+                length = src_len[batch_ix].max()
+                batch = buffers[i % len(buffers)][:len(batch_ix) * length].reshape([len(batch_ix), length])
+                yield np.take(src_ix[:, :length], batch_ix, axis=0, out=batch, mode='clip')
 
-        assert model_name != 'gnmt', 'gnmt no longer supported'
-        sy_translations = model.symbolic_translate(inp, back_prop=False, swap_memory=True).best_out
+        # next batches are prepared and copied to device in the background while previous ones are translated
+        dataset = tf.data.Dataset.from_generator(tokenized_batches, tf.int32, tf.TensorShape([None, None]))
+        batch_iterator = dataset.prefetch(PREFETCH_BATCHES).make_initializable_iterator()
+
+        with tf.device('/gpu:0'):
+            # a single host-to-device copy of each batch, before anything in the translation graph uses it
+            inp = tf.identity(batch_iterator.get_next())
+        sy_translations, = tf.import_graph_def(translation_graph_def, input_map={'inp:0': inp},
+                                               return_elements=['translations:0'], name='translate')
+
+        if not config.get('batch_size_for_inference') and len(order) == 0:
+            config['batch_size_for_inference'] = 1  # nothing to translate, nothing to calibrate on
+        elif not config.get('batch_size_for_inference'):
+            # calibrate on the longest lines, they need the most memory
+            # batches larger than the corpus, rounded up to a power of two, are never used
+            sample = src_ix[order[-16:]]
+            max_batch_size = 1 << (len(order) - 1).bit_length()
+            candidates = [batch_size for batch_size in (1, 2, 4, 8, 16, 32, 64, 128) if batch_size <= max_batch_size]
+            config['batch_size_for_inference'] = autotune_batch_size(sess, sy_translations, inp, sample, candidates)
+            print('Using batch size %i' % config['batch_size_for_inference'])
+
+        iterator_init = batch_iterator.initializer
+        if config.get('use_trt'):
+            print('Optimizing the graph with TensorRT')
+            sess, (sy_translations, iterator_init) = optimize_with_tensorrt(
+                sess, [sy_translations, iterator_init], config.get('batch_size_for_inference', 1),
+                precision_mode=config.get('trt_precision_mode', 'FP16'), session_config=session_config)
+
+        sess.run(iterator_init)
+        translate_next_batch = sess.make_callable(sy_translations)
+        sess.graph.finalize()  # nothing below may add ops to the graph
+        num_translated = 0
+        num_batches = int(np.ceil(len(order) / config['batch_size_for_inference']))
+        written_batches = []
+
+        # translations come shortest input first. They are detokenized and spilled to a temporary file
+        # in a background thread while the session is busy; the output file is written in the end
+        with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(output_path))) as spill_file:
+            output_writer = SpilledLineWriter(spill_file, len(order))
+
+            def write_batch(batch_ix, trans_ix):
+                # deprocess = True gets rid of BOS and EOS
+                output_writer.write(batch_ix, out_voc.detokenize_many(trans_ix, unbpe=True, deprocess=True))
+
+            with ThreadPoolExecutor(max_workers=1) as writer, \
+                    tqdm(total=num_batches, mininterval=1.0, smoothing=0, disable=not sys.stderr.isatty()) as progress:
+                while True:
+                    try:
+                        trans_ix = translate_next_batch()
+                    except tf.errors.OutOfRangeError:
+                        break
+                    batch_ix = order[num_translated:num_translated + len(trans_ix)]
+                    written_batches.append(writer.submit(write_batch, batch_ix, trans_ix))
+                    num_translated += len(trans_ix)
+                    progress.update()
+
+            for batch in written_batches:
+                batch.result()  # re-raise errors from the writer thread, if any
 
-        translations = []
+            print('Writing translations into %s' % output_path)
+            with open(output_path, 'wb', buffering=1 << 20) as output_file:
+                output_writer.copy_to(output_file)
 
-        for batch in tqdm(iterate_minibatches(src_data, batchsize=config.get('batch_size_for_inference'))):
-            batch_data_ix = inp_voc.tokenize_many(batch[0])[:, :max_len]
-            trans_ix = sess.run([sy_translations], feed_dict={inp: batch_data_ix})[0]
-            # deprocess = True gets rid of BOS and EOS
-            trans = out_voc.detokenize_many(trans_ix, unbpe=True, deprocess=True)
-            translations.extend(trans)
+        if config.get('use_trt'):
+            sess.close()
 
-        print('Saving the results into %s' % output_path)
-        with open(output_path, 'wb') as output_file:
-            output_file.write('\n'.join(translations).encode('utf-8'))
 
 def main():
     parser = argparse.ArgumentParser(description='Run project commands')
@@ -75,6 +291,10 @@ def main():
     parser.add_argument('--batch_size_for_inference', type=int)
     parser.add_argument('--max_input_len', type=int)
     parser.add_argument('--gpu_memory_fraction', type=float)
+    parser.add_argument('--xla_jit', action='store_true', help='compile the whole inference graph with XLA')
+    parser.add_argument('--use_trt', action='store_true', help='optimize the graph with TF-TRT before inference')
+    parser.add_argument('--trt_precision_mode', help='FP32 or FP16 (default)')
+    parser.add_argument('--graph_cache_dir', help='save frozen graphs here and reuse them on later runs')
 
     args = parser.parse_args()
 
@@ -76,8 +76,7 @@ def train_model(model_name, config):
         all_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
         non_trainable_vars = list(set(all_vars).difference(set(weights)))
 
-        grads = tf.gradients(loss, weights)
-        grads = tf.clip_by_global_norm(grads, 100)[0]
+        grads = compute_gradients(loss, weights, hp)
         optimizer = create_optimizer(hp)
         train_step = optimizer.apply_gradients(zip(grads, weights))
 
@@ -97,6 +97,17 @@ def create_gpu_options(config):
     return gpu_options
 
 
+def create_session_config(config):
+    # ops pinned to GPU fall back to CPU if there is no GPU or no GPU kernel for them
+    session_config = tf.ConfigProto(gpu_options=create_gpu_options(config), allow_soft_placement=True)
+
+    if config.get('xla_jit'):
+        # also compiles ops outside of model's jit scopes, e.g. beam search bookkeeping in the while_loop body
+        session_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+    return session_config
+
+
 def create_optimizer(hp):
     lr = hp.get('lr', 1e-4)
     beta2 = hp.get('beta2', 0.98)
@@ -104,6 +115,25 @@ def create_optimizer(hp):
     return tf.train.AdamOptimizer(learning_rate=lr, beta2=beta2)
 
 
+def compute_gradients(loss, weights, hp, clip_norm=100):
+    """
+    Gradients of loss w.r.t. weights, clipped by global norm.
+    With hp['loss_scale'] (static loss scaling, needed e.g. for compute_dtype='float16'), backprop starts
+    from loss * loss_scale so that small float16 gradients do not underflow, and gradients are divided back
+    """
+    loss_scale = hp.get('loss_scale', 1.0)
+    grads = tf.gradients(loss * loss_scale, weights)
+
+    if loss_scale != 1.0:
+        def unscale(grad):
+            if isinstance(grad, tf.IndexedSlices):  # e.g. embedding gradients
+                return tf.IndexedSlices(grad.values / loss_scale, grad.indices, grad.dense_shape)
+            return grad / loss_scale if grad is not None else None
+        grads = [unscale(grad) for grad in grads]
+
+    return tf.clip_by_global_norm(grads, clip_norm)[0]
+
+
 def iterate_minibatches(*to_split, **kwargs):
     """
         generates batches from the data, passed as first arguments
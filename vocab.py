@@ -1,4 +1,6 @@
 import numpy as np
+from array import array
+from itertools import chain
 
 
 class Vocab:
@@ -18,6 +20,7 @@ class Vocab:
 
         self.tokens = tokens
         self.token2id = {token: i for i, token in enumerate(self.tokens)}
+        self._id2tok = np.array(self.tokens, dtype=object)
         self.bos = 0
         self.eos = 1
         self.unk = 2
@@ -73,13 +76,43 @@ class Vocab:
         """
         max_len = max_len or max(map(lambda s: len(s.split(sep)), lines)) + 2  # 2 for bos and eos
 
-        matrix = np.zeros((len(lines), max_len), dtype='int32') + self.eos
-        for i, seq in enumerate(lines):
-            tokens = self.tokenize(seq)[:max_len]
-            matrix[i, :len(tokens)] = tokens
+        matrix = np.full((len(lines), max_len), self.eos, dtype='int32')
+        sequences = [self.tokenize(seq)[:max_len] for seq in lines]
+        lengths = np.array([len(seq) for seq in sequences], dtype='int32')
+        ids = np.fromiter(chain.from_iterable(sequences), dtype='int32', count=int(lengths.sum()))
+        self._fill_padded(matrix, ids, lengths)
 
         return matrix
 
+    def tokenize_corpus(self, lines, max_len=None, sep=' '):
+        """
+        Converts a whole corpus into a single padded matrix at once, e.g. before batching
+        :param lines: an iterable of strings, e.g. lines of a file read lazily
+        :param max_len: if given, crops sequences to this many tokens (including BOS and EOS)
+        :return: matrix of ids, int32[num_lines, max_line_len], padded with self.eos
+                 and lengths of sequences, int32[num_lines]
+        """
+        # ids are streamed into a flat C int array (4 bytes per token) instead of a list of lists
+        ids, lengths = array('i'), array('i')
+        for line in lines:
+            seq = self.tokenize(line, sep)[:max_len]
+            ids.extend(seq)
+            lengths.append(len(seq))
+        ids, lengths = np.asarray(ids, dtype='int32'), np.asarray(lengths, dtype='int32')
+
+        matrix = np.full([len(lengths), lengths.max() if len(lengths) else 0], self.eos, dtype='int32')
+        self._fill_padded(matrix, ids, lengths)
+        return matrix, lengths
+
+    @staticmethod
+    def _fill_padded(matrix, ids, lengths):
+        """
+        Writes sequences of ids into the beginning of matrix rows with one masked assignment
+        :param ids: ids of all sequences concatenated, int[sum(lengths)]
+        :param lengths: lengths of sequences, int32[matrix.shape[0]]
+        """
+        matrix[np.arange(matrix.shape[1]) < lengths[:, None]] = ids
+
     def detokenize_many(self, matrix, crop=True, sep=' ', unbpe=False, deprocess=False):
         """
         Convert matrix of token ids into strings
@@ -90,7 +123,20 @@ class Vocab:
         :param deprocess: if True, removes all unknowns
         :return: a list of strings of
         """
-        return [self.detokenize(sent, crop, sep, unbpe, deprocess) for sent in matrix]
+        matrix = np.asarray(matrix)
+        is_eos = matrix == self.eos
+        keep = np.cumsum(is_eos, axis=1) - is_eos == 0  # everything up to and including the first EOS
+        if deprocess:
+            keep &= matrix >= len(self._default_tokens)
+
+        lines = [row[row_keep] for row, row_keep in zip(self._id2tok[matrix], keep)]
+        if sep is None:
+            return [list(tokens) for tokens in lines]
+
+        lines = [sep.join(tokens) for tokens in lines]
+        if unbpe:
+            lines = self.remove_bpe_many(lines)
+        return lines
 
     @classmethod
     def from_file(cls, voc_path):